@@ -21,6 +21,7 @@
 
 import argparse
 import errno
+import functools
 import logging
 import operator
 import random
@@ -33,18 +34,18 @@ import sys
 import multiprocessing
 import concurrent.futures
 
-from collections import OrderedDict
 from filecmp import dircmp
 from io import StringIO
 from multiprocessing import cpu_count
 from os import chmod, listdir, lstat, mkdir, name as os_name
-from os import path, readlink, remove, rmdir, symlink, sep
-from os import stat, utime, walk
-from shutil import copymode, copystat, copyfile, copytree, copy2, rmtree
+from os import path, readlink, remove, rename, replace, rmdir, symlink, sep
+from os import scandir, stat, utime, walk
+from shutil import copymode, copystat, copyfile, copyfileobj, copytree, copy2, rmtree
+from shutil import which
 from stat import *
-from subprocess import check_output, STDOUT, CalledProcessError
+from subprocess import check_output, Popen, PIPE, STDOUT, CalledProcessError
 from sys import hexversion, stderr, stdout
-from tempfile import mkdtemp
+from tempfile import mkdtemp, mkstemp, SpooledTemporaryFile
 
 if os_name != "nt":
     from grp import getgrgid
@@ -53,6 +54,36 @@ if os_name != "nt":
 
 from os import open as os_open  # Prevent mangling the regular open()
 from os import makedirs as os_makedirs
+from os import close, O_RDONLY, supports_dir_fd, supports_fd
+
+# Whether directories can be listed through file descriptors
+USE_DIR_FD = scandir in supports_fd and readlink in supports_dir_fd
+
+# Optional: parallel gzip decompression for tar archives
+try:
+    import rapidgzip
+except ImportError:
+    rapidgzip = None
+
+# Optional: zstd compressed patch bundles
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Optional: in-process xdelta3 bindings to skip a fork+exec per file
+# XXX: The only release of the bindings (0.0.5) imports fine but fails every
+#      call on python >= 3.10 ("PY_SSIZE_T_CLEAN macro must be defined") so
+#      on current interpreters this path needs a build with that fixed. The
+#      probe below disables the module if it doesn't actually work and we
+#      then always use the xdelta3 tool.
+try:
+    import xdelta3
+
+    _probe_data = bytes(range(256)) * 16
+    xdelta3.decode(_probe_data, xdelta3.encode(_probe_data, _probe_data[1:]))
+except Exception:
+    xdelta3 = None
 
 VERSION = "0.6.4"
 
@@ -74,6 +105,49 @@ else:
     # Use regular os.makedirs
     makedirs = os_makedirs
 
+
+def cached_makedirs(target_dir, created_dirs, lock):
+    """makedirs() that skips the mkdir syscalls for directories (and their
+    ancestors) that are already in created_dirs. Many paths share the same
+    parents so this saves most of them.
+    """
+    if target_dir in created_dirs:
+        return
+
+    with lock:
+        makedirs(target_dir, exist_ok=True)
+
+        while target_dir and target_dir not in created_dirs:
+            created_dirs.add(target_dir)
+            target_dir = path.dirname(target_dir)
+
+
+# NSS lookups may end up hitting the network (LDAP/SSSD) so we only ever
+# resolve each unique id once per run
+@functools.lru_cache(maxsize=None)
+def _uname_for(uid):
+    try:
+        return getpwuid(uid)[0]
+    except KeyError as ke:
+        pass
+    except NameError as ne:
+        pass
+
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def _gname_for(gid):
+    try:
+        return getgrgid(gid)[0]
+    except KeyError as ke:
+        pass
+    except NameError as ne:
+        pass
+
+    return None
+
+
 # Allows for invoking attributes as methods/functions
 class AttributeDict(dict):
     def __getattr__(self, attr):
@@ -84,6 +158,48 @@ class AttributeDict(dict):
 
 
 # ---------------------------- DIR LISTING ----------------------------
+# Precomputed 'rwxrwxrwx'-style strings for every possible permission mask
+PERMISSION_STRINGS = tuple(
+    "".join(
+        letter if (mode >> (8 - index)) & 1 else "-"
+        for index, letter in enumerate("rwxrwxrwx")
+    )
+    for mode in range(0o1000)
+)
+
+
+# Slotted record for non-directory members since archives can have millions
+# of them and a per-instance dict would dominate memory use
+class FileRecord(object):
+    __slots__ = (
+        "name",
+        "permissions",
+        "data",
+        "uname",
+        "uid",
+        "gname",
+        "gid",
+        "is_link",
+        "link_target",
+    )
+
+    is_file = True
+    is_dir = False
+
+    def __init__(
+        self, name, data, permissions, uname, uid, gname, gid, is_link, link_target=None
+    ):
+        self.name = name
+        self.permissions = permissions
+        self.data = data
+        self.uname = uname
+        self.uid = uid
+        self.gname = gname
+        self.gid = gid
+        self.is_link = is_link
+        self.link_target = link_target
+
+
 class DirListing(object):
     def __init__(self, name=None):
         self._files = []
@@ -123,46 +239,20 @@ class DirListing(object):
     def add_file(
         self, name, data, permissions, uname, uid, gname, gid, is_link, link_target=None
     ):
-        file_dict = {
-            "name": name,
-            "permissions": permissions,
-            "data": data,
-            "uname": uname,
-            "uid": uid,
-            "gname": gname,
-            "gid": gid,
-            "is_link": is_link,
-            "is_file": True,
-            "is_dir": False,
-            "link_target": link_target,
-        }
-
-        self._files.append(AttributeDict(file_dict))
-
-        return self._files[-1]
+        file_obj = FileRecord(
+            name, data, permissions, uname, uid, gname, gid, is_link, link_target
+        )
+
+        self._files.append(file_obj)
+
+        return file_obj
 
     def _formatted_file_str(self, file_obj):
         output_str = file_obj.name
 
-        permission_letters = "rwxrwxrwx"
-        permission_masks = [
-            S_IRUSR,
-            S_IWUSR,
-            S_IXUSR,
-            S_IRGRP,
-            S_IWGRP,
-            S_IXGRP,
-            S_IROTH,
-            S_IWOTH,
-            S_IXOTH,
-        ]
-
         permissions = ""
         if file_obj.permissions:
-            permissions += "("
-            for letter, mask in zip(permission_letters, permission_masks):
-                permissions += letter if mask & file_obj.permissions else "-"
-            permissions += ")"
+            permissions = "(" + PERMISSION_STRINGS[file_obj.permissions & 0o777] + ")"
 
         is_link = "-> %s" % file_obj.link_target if file_obj.is_link else ""
 
@@ -170,23 +260,39 @@ class DirListing(object):
         return output_str
 
     def _print_dir_listing(self, root, output, root_path=""):
-        assert root and root.name, "Cannot print listing in path: '%s'" % root_path
+        # Explicit stack rather than recursion so that deep trees don't hit
+        # the recursion limit. Entries are either directories that still need
+        # to be listed or the files of an already listed directory which go
+        # out after all of its subdirectories (same as a depth-first print).
+        root_padding = path.join(root_path, root.name).count(path.sep) if root else 0
+        stack = [(root, root_path, root_padding, False)]
+        indents = {}
+        while stack:
+            node, node_path, padding, files_only = stack.pop()
+
+            indent = indents.get(padding)
+            if indent is None:
+                indent = indents[padding] = "| " * padding
+
+            if files_only:
+                for filename in node.files:
+                    print(indent + "-", self._formatted_file_str(filename), file=output)
+                continue
 
-        relative_path = path.join(root_path, root.name)
-        padding = relative_path.count(path.sep)
-        is_link = "-> %s" % root.link_target if root.is_link else ""
+            assert node and node.name, "Cannot print listing in path: '%s'" % node_path
 
-        print("| " * padding + "v", relative_path, is_link, file=output)
+            relative_path = path.join(node_path, node.name)
+            is_link = "-> %s" % node.link_target if node.is_link else ""
 
-        for subdir in root.dirs:
-            dir_path = path.join(root_path, root.name)
-            if not root_path:
-                dir_path = path.sep
+            print(indent + "v", relative_path, is_link, file=output)
 
-            self._print_dir_listing(subdir, output, dir_path)
+            dir_path = relative_path
+            if not node_path:
+                dir_path = path.sep
 
-        for filename in root.files:
-            print("| " * padding + "-", self._formatted_file_str(filename), file=output)
+            stack.append((node, node_path, padding, True))
+            for subdir in reversed(node.dirs):
+                stack.append((subdir, dir_path, padding + 1, False))
 
     def __repr__(self):
         return self.__str__()
@@ -202,31 +308,157 @@ class DirListing(object):
 
 
 # ---------------------------- PROCESS RUNNER ----------------------------
+class ProgressPrinter(object):
+    """Periodically prints a symbol for each tick since the last print so
+    that worker threads don't all contend on writing/flushing stdout
+    """
+
+    def __init__(self, symbol, interval=0.25):
+        self.symbol = symbol
+        self.interval = interval
+
+        # Taken at most once per task so this is nowhere near the contention
+        # that writing to stdout from every task had
+        self._lock = threading.Lock()
+        self._ticks = 0
+        self._printed = 0
+
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def tick(self, count=1):
+        with self._lock:
+            self._ticks += count
+
+    def _flush(self):
+        with self._lock:
+            ticks = self._ticks
+
+        if ticks > self._printed:
+            stdout.write(self.symbol * (ticks - self._printed))
+            stdout.flush()
+
+            self._printed = ticks
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            self._flush()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+        self._flush()
+
+
 class ExecutorRunner(object):
-    def __init__(self, debug=False):
+    BACKENDS = ("thread", "process")
+
+    def __init__(self, debug=False, backend="thread"):
         # multiprocessing.log_to_stderr(logging.DEBUG)
+        assert backend in self.BACKENDS, "Unknown runner backend: %s" % backend
 
         self.futures = []
+        self.results = []
+        self.progress_printers = []
         self.start_time = None
-        thread_count = max(cpu_count() - 1, 1)
 
         self.debug = debug
+        self.backend = backend
+
+        # XXX: The process backend can only be used with tasks whose
+        #      functions and arguments are picklable so anything that
+        #      shares open tarfile/zipfile handles needs to stay on threads
+        if backend == "process":
+            # The workers get created once we are already running the
+            # progress printer (and possibly rapidgzip) threads and forking
+            # a multi-threaded process can deadlock the children on locks
+            # like the one of stdout so we start them from a clean server
+            mp_context = None
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                mp_context = multiprocessing.get_context("forkserver")
+
+            self.worker_count = cpu_count()
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                self.worker_count, mp_context=mp_context
+            )
+        else:
+            self.worker_count = max(cpu_count() - 1, 1)
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.worker_count)
+
+    def progress(self, symbol):
+        progress_printer = ProgressPrinter(symbol)
+        self.progress_printers.append(progress_printer)
 
-        self.executor = concurrent.futures.ThreadPoolExecutor(thread_count)
+        return progress_printer
+
+    def _stop_progress(self):
+        progress_printers, self.progress_printers = self.progress_printers, []
+        for progress_printer in progress_printers:
+            progress_printer.stop()
 
     def _fix_terminal(self):
         stdout.flush()
         print()
 
-    def add_task(self, target_func, target_func_args):
+    def add_task(self, target_func, target_func_args, progress=None, ticks=1):
         if self.start_time == None:
             self.start_time = time.time()
 
-        self.futures.append(self.executor.submit(target_func, *target_func_args))
+        future = self.executor.submit(target_func, *target_func_args)
+        self.futures.append(future)
+
+        # Done callbacks always run in our process so this works with
+        # either backend
+        if progress:
+            future.add_done_callback(lambda _: progress.tick(ticks))
 
         # XXX: For single-threaded debugging
         # target_func(*target_func_args)
 
+        return future
+
+    def map(self, target_func, target_func_args_list, chunksize=None):
+        if self.start_time == None:
+            self.start_time = time.time()
+
+        target_func_args_list = list(target_func_args_list)
+        if not target_func_args_list:
+            return
+
+        # Batching tasks amortizes the IPC cost of the process backend
+        # (thread pools ignore the chunksize)
+        if not chunksize:
+            chunksize = max(1, len(target_func_args_list) // (self.worker_count * 4))
+
+        self.results.append(
+            self.executor.map(
+                target_func, *zip(*target_func_args_list), chunksize=chunksize
+            )
+        )
+
+    def shutdown(self):
+        # Process pools need to be fully shut down before the interpreter
+        # exits or their management thread may use already closed pipes
+        if hexversion >= 0x30900F0:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+        else:
+            # XXX: Python < 3.9 can't drop the queued tasks for us so these
+            #      still run to completion on failures
+            self.executor.shutdown(wait=True)
+
+        self._stop_progress()
+
+    def results_of(self, futures):
+        # For callers that need some of the results before join_all(). If any
+        # of the tasks failed, we clean up just like join_all() would.
+        try:
+            return [future.result() for future in futures]
+        except BaseException:
+            self.shutdown()
+            raise
+
     def join_all(self):
         if self.debug:
             # Make sure that the terminal isn't in some strange state
@@ -237,9 +469,24 @@ class ExecutorRunner(object):
         # Prevent further scheduling
         self.executor.shutdown(False)
 
-        for future in concurrent.futures.as_completed(self.futures):
-            if future.exception():
-                raise future.exception()
+        try:
+            # Only wake up once everything is done or as soon as something
+            # fails rather than on each completed task
+            futures, self.futures = self.futures, []
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_EXCEPTION
+            )
+            for future in done:
+                if future.exception():
+                    raise future.exception()
+
+            # Draining the mapped results re-raises any exception from the tasks
+            results, self.results = self.results, []
+            for result in results:
+                for _ in result:
+                    pass
+        finally:
+            self.shutdown()
 
         # Leftover runners might have again clobbered the output
         self._fix_terminal()
@@ -272,20 +519,49 @@ class XDeltaArchive(object):
 
 
 class XDelta3AbstractArchiveImpl(object):
+    # Archives that are expensive to read out-of-order get expanded in a
+    # single batch ahead of the per-file tasks instead of from each task
+    SEQUENTIAL_ACCESS = False
+
     def __init__(self):
         self.lock = threading.RLock()
 
+        # Directories (and their ancestors) that we know exist already
+        self._created_dirs = set()
+
     def _acquire_lock(self):
         self.lock.acquire()
 
     def _release_lock(self):
         self.lock.release()
 
+    def _safe_makedirs(self, target_dir):
+        cached_makedirs(target_dir, self._created_dirs, self.lock)
+
     def list_items(self):
         assert self.members
 
         return self.members
 
+    def extract_many(self, roots, extraction_path):
+        for root in roots:
+            self.expand(root, extraction_path)
+
+    def stream_members(self, roots):
+        # Yields (root, listing object, data) tuples with the contents of
+        # regular files read into memory so that nothing needs to get staged
+        # on disk. Directories and symlinks are yielded with no data.
+        for root in roots:
+            assert root in self.members, "Unknown member path specified: %s" % root
+
+            file_obj = self.members[root]
+
+            data = None
+            if file_obj.is_file and not file_obj.is_link:
+                data = self.read_member(root)
+
+            yield root, file_obj, data
+
 
 class XDelta3FsImpl(XDelta3AbstractArchiveImpl):
     def __init__(self, path, for_writing=False):
@@ -313,88 +589,133 @@ class XDelta3FsImpl(XDelta3AbstractArchiveImpl):
     def can_open(archive):
         return path.isdir(archive)
 
-    def _add_listing_object(self, dir_listing, method, absolute_path):
-        uid = lstat(absolute_path).st_uid
-        gid = lstat(absolute_path).st_gid
-        mode = S_IMODE(lstat(absolute_path).st_mode)
+    def _add_listing_object(
+        self, dir_listing, method, name, absolute_path, st, dir_fd=None
+    ):
+        uid = st.st_uid
+        gid = st.st_gid
+        mode = S_IMODE(st.st_mode)
 
-        group = None
-        try:
-            group = getgrgid(gid)[0]
-        except KeyError as ke:
-            pass
-        except NameError as ne:
-            pass
-
-        user = None
-        try:
-            user = (getpwuid(uid)[0],)
-        except KeyError as ke:
-            pass
-        except NameError as ne:
-            pass
+        group = _gname_for(gid)
+        user = _uname_for(uid)
 
         setter_func = getattr(dir_listing, method)
 
         file_obj = setter_func(
-            path.basename(absolute_path),
+            name,
             absolute_path,
             mode,
             user,
             uid,
             group,
             gid,
-            path.islink(absolute_path),
+            S_ISLNK(st.st_mode),
         )
 
         if file_obj and file_obj.is_link:
-            file_obj.link_target = readlink(absolute_path)
+            if dir_fd is not None:
+                file_obj.link_target = readlink(name, dir_fd=dir_fd)
+            else:
+                file_obj.link_target = readlink(absolute_path)
 
         return file_obj
 
+    def _scan_dir(self, absolute_dir, relative_dir, current_dir):
+        # Each scan only ever touches its own DirListing so this can safely
+        # run on any thread. Found members are buffered locally and merged
+        # into the member tree by the caller.
+        listing = [(relative_dir, current_dir)]
+        subdirs = []
+
+        # With a directory fd the per-entry lstat/readlink calls become
+        # fstatat/readlinkat so the kernel doesn't need to resolve the whole
+        # path prefix again for every entry
+        dir_fd = None
+        if USE_DIR_FD:
+            dir_fd = os_open(absolute_dir, O_RDONLY)
+
+        try:
+            scandir_it = scandir(absolute_dir if dir_fd is None else dir_fd)
+            try:
+                for entry in scandir_it:
+                    # The stat result gets passed along so that each entry is
+                    # only ever lstat'ed once during the listing pass
+                    st = entry.stat(follow_symlinks=False)
+                    absolute_path = path.join(absolute_dir, entry.name)
+                    relative_path = entry.name
+                    if relative_dir:
+                        relative_path = path.join(relative_dir, entry.name)
+
+                    # Symlinks to directories are treated as regular files
+                    if S_ISDIR(st.st_mode):
+                        subdir = DirListing()
+                        self._add_listing_object(
+                            subdir,
+                            "set_metadata",
+                            entry.name,
+                            absolute_path,
+                            st,
+                            dir_fd,
+                        )
+                        current_dir.add_subdir(subdir)
+
+                        subdirs.append((absolute_path, relative_path, subdir))
+                    else:
+                        # Have the listing for the file in the map but
+                        # don't associate a DirListing object to it
+                        file_dict = self._add_listing_object(
+                            current_dir,
+                            "add_file",
+                            entry.name,
+                            absolute_path,
+                            st,
+                            dir_fd,
+                        )
+
+                        listing.append((relative_path, file_dict))
+            finally:
+                scandir_it.close()
+        finally:
+            if dir_fd is not None:
+                close(dir_fd)
+
+        return listing, subdirs
+
     # XXX: Not thread safe when uninitialized
     @property
     def members(self):
-        if self._members:
+        if self._members is not None:
             return self._members
 
         print("FS: Gathering filelist (%s/)" % path.basename(self.path))
-        member_tree = {}
-        member_tree["."] = DirListing(path.basename(self.path))
-        for root, dirs, filenames in walk(self.path):
-            relative_path = path.relpath(root, self.path)
-
-            current_dir = DirListing()
-            member_tree[relative_path] = current_dir
-
-            parent_dir = path.dirname(relative_path)
-            if root != self.path and not parent_dir:
-                parent_dir = "."
-
-            self._add_listing_object(current_dir, "set_metadata", root)
-
-            if parent_dir in member_tree:
-                member_tree[parent_dir].add_subdir(current_dir)
 
-            files_to_process = filenames
-            for directory in dirs:
-                if path.islink(path.join(root, directory)):
-                    files_to_process.append(directory)
-
-            for filename in files_to_process:
-                absolute_path = path.join(root, filename)
-                relative_path = path.relpath(absolute_path, self.path)
+        root_dir = DirListing()
+        self._add_listing_object(
+            root_dir,
+            "set_metadata",
+            path.basename(self.path),
+            self.path,
+            lstat(self.path),
+        )
 
-                # Have the listing for the file in the map but
-                # don't associate a DirListing object to it
-                file_dict = self._add_listing_object(
-                    current_dir, "add_file", absolute_path
+        # The listing is bound by scandir/lstat syscalls (which release the
+        # GIL) so we fan out every subdirectory scan onto a thread pool. A
+        # directory always gets merged in before any of its children.
+        member_tree = {}
+        with concurrent.futures.ThreadPoolExecutor(cpu_count() * 4) as executor:
+            # Make sure that the root has a real unique value rather than '.'
+            pending = {executor.submit(self._scan_dir, self.path, None, root_dir)}
+            while pending:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
                 )
 
-                member_tree[relative_path] = file_dict
+                for future in done:
+                    listing, subdirs = future.result()
+                    member_tree.update(listing)
 
-        # Make sure that the root has a real unique value rather than '.'
-        member_tree[None] = member_tree.pop(".")
+                    for subdir_args in subdirs:
+                        pending.add(executor.submit(self._scan_dir, *subdir_args))
 
         print("FS: Gathering completed (%s/)" % path.basename(self.path))
 
@@ -416,17 +737,17 @@ class XDelta3FsImpl(XDelta3AbstractArchiveImpl):
         dir_path = path.dirname(target_path)
 
         if root_obj.is_link:
-            makedirs(dir_path, exist_ok=True)
+            self._safe_makedirs(dir_path)
 
             source_path = path.abspath(source_path)
             target_path = path.abspath(target_path)
 
             symlink(root_obj.link_target, target_path)
         elif root_obj.is_file:
-            makedirs(dir_path, exist_ok=True)
+            self._safe_makedirs(dir_path)
             copy2(source_path, target_path, follow_symlinks=False)
         else:
-            makedirs(target_path, exist_ok=True)
+            self._safe_makedirs(target_path)
 
             # TODO: Test me
             # Ensure that permissions/ids are transferred along to the target
@@ -446,6 +767,10 @@ class XDelta3FsImpl(XDelta3AbstractArchiveImpl):
             except NameError as ne:
                 pass
 
+    def read_member(self, root):
+        with open(path.join(self.path, root), "rb") as member_file:
+            return member_file.read()
+
     def create(self, base_dir):
         if path.isdir(self.path):
             raise Exception("Error! Archive already present!")
@@ -454,7 +779,13 @@ class XDelta3FsImpl(XDelta3AbstractArchiveImpl):
 
 
 class XDelta3TarImpl(XDelta3AbstractArchiveImpl):
+    SEQUENTIAL_ACCESS = True
     TAR_FORMAT = "gz"
+    GZIP_EXTENSIONS = (".gz", ".tgz")
+    ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+    # Decompressed zstd archives spill over to disk beyond this size
+    ZSTD_SPOOL_MAX_SIZE = 64 * 1024 * 1024
 
     def __init__(self, archive_path, for_writing=False):
         super().__init__()
@@ -468,16 +799,57 @@ class XDelta3TarImpl(XDelta3AbstractArchiveImpl):
 
             flags = "w:%s" % self.TAR_FORMAT
 
-        self.archive_object = tarfile.open(archive_path, flags)
-        self.archive_name = path.basename(archive_path)
+        self._fileobj = None
+        self.archive_object = None
+        try:
+            # Stdlib gzip decompression is single-threaded so if we can, we hand
+            # tarfile an already-decompressed (and still seekable) stream instead
+            if not for_writing and self._is_zstd(archive_path):
+                # Tarfile can't read zstd itself and the decompressed stream
+                # isn't seekable so we decompress it up front
+                if not zstandard:
+                    raise RuntimeError(
+                        "Error! %s is zstd compressed but the zstandard module "
+                        "is not installed!" % archive_path
+                    )
+
+                self._fileobj = SpooledTemporaryFile(self.ZSTD_SPOOL_MAX_SIZE)
+                with open(archive_path, "rb") as zstd_file:
+                    zstandard.ZstdDecompressor().copy_stream(zstd_file, self._fileobj)
+                self._fileobj.seek(0)
+
+                self.archive_object = tarfile.open(fileobj=self._fileobj, mode="r:")
+            elif (
+                not for_writing
+                and rapidgzip
+                and archive_path.endswith(self.GZIP_EXTENSIONS)
+            ):
+                self._fileobj = rapidgzip.RapidgzipFile(
+                    archive_path, parallelization=cpu_count()
+                )
+                self.archive_object = tarfile.open(fileobj=self._fileobj, mode="r:")
+            else:
+                self.archive_object = tarfile.open(archive_path, flags)
 
-        # Pre-fetch member data to ensure only one thread tries to create
-        # the initial list and to allow further listings to not need locks
-        if not for_writing:
-            self.list_items()
+            self.archive_name = path.basename(archive_path)
+
+            # Pre-fetch member data to ensure only one thread tries to create
+            # the initial list and to allow further listings to not need locks
+            if not for_writing:
+                self.list_items()
+        except BaseException:
+            # Nothing else would close the stream on errors and rapidgzip
+            # aborts the interpreter at exit if its threads are still running
+            self._close_archive()
+            raise
 
     def _close_archive(self):
-        self.archive_object.close()
+        if self.archive_object is not None:
+            self.archive_object.close()
+
+        # Tarfile doesn't close file objects that were handed to it
+        if self._fileobj:
+            self._fileobj.close()
 
     def __enter__(self):
         return self
@@ -488,15 +860,23 @@ class XDelta3TarImpl(XDelta3AbstractArchiveImpl):
     def close(self):
         self._close_archive()
 
+    @staticmethod
+    def _is_zstd(archive):
+        with open(archive, "rb") as archive_file:
+            return archive_file.read(4) == XDelta3TarImpl.ZSTD_MAGIC
+
     @staticmethod
     def can_open(archive):
-        return path.isfile(archive) and tarfile.is_tarfile(archive)
+        if not path.isfile(archive):
+            return False
+
+        return XDelta3TarImpl._is_zstd(archive) or tarfile.is_tarfile(archive)
 
-    def _add_listing_object(self, dir_listing, method, member):
+    def _add_listing_object(self, dir_listing, method, member, name):
         setter_func = getattr(dir_listing, method)
 
         file_obj = setter_func(
-            path.basename(member.name),
+            name,
             member,
             member.mode,
             member.uname,
@@ -512,60 +892,59 @@ class XDelta3TarImpl(XDelta3AbstractArchiveImpl):
         return file_obj
 
     def _create_dir_structure_to(self, items, target_path):
-        target_path_segments = target_path.split(path.sep)
-        for index, segment in enumerate(target_path_segments):
-            segment_path = path.sep.join(target_path_segments[0 : index + 1])
-
-            # Skip paths that are in hierarchy
-            if segment_path in items:
-                continue
-
-            parent_obj = items[None]
-            if index != 0:
-                parent_obj = items[path.dirname(segment_path)]
-
+        # Walk up until we hit a path that is in hierarchy so that only the
+        # missing levels get created
+        missing_segments = []
+        segment_path = target_path
+        while segment_path and segment_path not in items:
+            parent_path, _, segment = segment_path.rpartition("/")
+            missing_segments.append((segment_path, segment))
+            segment_path = parent_path
+
+        parent_obj = items[segment_path or None]
+        for segment_path, segment in reversed(missing_segments):
             subdir_obj = DirListing(segment)
             parent_obj.add_subdir(subdir_obj)
 
             items[segment_path] = subdir_obj
-
-    def _safe_makedirs(self, target_dir):
-        super()._acquire_lock()
-        makedirs(target_dir, exist_ok=True)
-        super()._release_lock()
+            parent_obj = subdir_obj
 
     # XXX: Not thread safe when uninitialized
     @property
     def members(self):
-        if self._items:
+        if self._items is not None:
             return self._items
 
         print("Tar: Gathering filelist (%s)" % self.archive_name)
-        members = self.archive_object.getmembers()
 
-        # Lookup all member objects. Order is not ensured so we
+        # Lookup all member objects in a single forward pass over the
+        # (possibly compressed) stream. Order is not ensured so we
         # need to do a 2-pass run to assign the proper hierarchy
-        # to DirListing objects and files
+        # to DirListing objects and files. Member names always use "/"
+        # regardless of the platform.
+        members = []
         folders = []
         files = []
-        for member in members:
+        for member in self.archive_object:
+            members.append(member)
             if member.isdir():
-                folders.append((member.name.rstrip(path.sep), member))
+                name = member.name.rstrip("/")
+                folders.append((name, name.rpartition("/"), member))
             else:
-                files.append((member.name, member))
+                files.append((member.name, member.name.rpartition("/"), member))
 
-        # Sort the directories - we want to navigate from trunk to leaf nodes
-        sorted_dirs = sorted(folders, key=lambda f: len(f[0]))
+        # Sort the directories by depth - we want to navigate from trunk
+        # to leaf nodes
+        sorted_dirs = sorted(folders, key=lambda f: f[0].count("/"))
 
         # Create the folder structure
         items = {None: DirListing(self.archive_name)}
-        for folder, member in sorted_dirs:
-            parent_dir = path.dirname(folder)
+        for folder, (parent_dir, _, basename), member in sorted_dirs:
             if not parent_dir:
                 parent_dir = None
             current_dir = DirListing()
 
-            self._add_listing_object(current_dir, "set_metadata", member)
+            self._add_listing_object(current_dir, "set_metadata", member, basename)
 
             items[folder] = current_dir
 
@@ -573,28 +952,29 @@ class XDelta3TarImpl(XDelta3AbstractArchiveImpl):
                 items[parent_dir].add_subdir(current_dir)
 
         # Add files to dirs
-        for filename, member in files:
-            dir_name = path.dirname(filename)
+        for filename, (dir_name, _, basename), member in files:
             if not dir_name:
                 dir_name = None
 
             # Create the missing structure if needed
-            if dir_name not in items.keys():
+            if dir_name not in items:
                 self._create_dir_structure_to(items, dir_name)
 
             current_dir = items[dir_name]
-            file_obj = self._add_listing_object(current_dir, "add_file", member)
+            file_obj = self._add_listing_object(
+                current_dir, "add_file", member, basename
+            )
 
             items[filename] = file_obj
 
         print("Tar: Gathering completed (%s)" % self.archive_name)
 
-        # Create an ordered list rather than a regular dictionary
-        # since tar archives are intended to be read sequentially
-        ordered_items = OrderedDict()
+        # Keep the items in archive order since tar archives are intended to
+        # be read sequentially (regular dicts preserve insertion order)
+        ordered_items = {}
         ordered_items[None] = items[None]
         for item in members:
-            ordered_items[item.name] = items.pop(item.name.rstrip(path.sep))
+            ordered_items[item.name] = items.pop(item.name.rstrip("/"))
 
         # Add back any items that we manually created (missing hierarchy)
         ordered_items.update(items)
@@ -603,7 +983,7 @@ class XDelta3TarImpl(XDelta3AbstractArchiveImpl):
 
         return self._items
 
-    def _expand_children(self, root, extraction_path):
+    def _expand_children(self, root, extraction_path, pending_members):
         file_obj = self.members[root]
 
         self._safe_makedirs(extraction_path)
@@ -613,15 +993,91 @@ class XDelta3TarImpl(XDelta3AbstractArchiveImpl):
             if root != None:
                 internal_path = path.join(root, item.name)
 
-            self.expand(internal_path, extraction_path)
+            self._expand_item(internal_path, extraction_path, pending_members)
+
+    def _extract_in_order(self, pending_members, extraction_path):
+        if not pending_members:
+            return
+
+        # Going through the members in archive order means that we only ever
+        # seek forward in the stream instead of restarting the decompression
+        # for each member that is behind the current position. Members can be
+        # queued more than once if their parent folder was requested too.
+        unique_members = {member.offset: member for member in pending_members}
+        sorted_members = sorted(
+            unique_members.values(), key=operator.attrgetter("offset")
+        )
+
+        # XXX: Not thread safe http://bugs.python.org/issue23649
+        super()._acquire_lock()
+        try:
+            for member in sorted_members:
+                self.archive_object.extract(member, extraction_path)
+        finally:
+            super()._release_lock()
 
     def expand(self, root, extraction_path):
         assert root in self.members, "Unknown member path specified: %s" % root
 
+        # Regular files are only queued up while we walk the hierarchy so
+        # that they can all get extracted in one pass
+        pending_members = []
+        self._expand_item(root, extraction_path, pending_members)
+        self._extract_in_order(pending_members, extraction_path)
+
+    def stream_members(self, roots):
+        # Reading the members in archive order makes this a single forward
+        # pass over the (possibly compressed) stream. Folders that we created
+        # for missing hierarchy have no member so they go first.
+        def member_offset(root):
+            member = self.members[root].data
+            return member.offset if member else -1
+
+        return super().stream_members(sorted(roots, key=member_offset))
+
+    def read_member(self, root):
+        member = self.members[root].data
+
+        super()._acquire_lock()
+        try:
+            if member.isreg() and not member.issparse():
+                # Regular members are stored in one piece so we read them
+                # right off of the stream. Going in archive order this is
+                # just a forward read with no per-member file objects.
+                fileobj = self.archive_object.fileobj
+                fileobj.seek(member.offset_data)
+
+                data = fileobj.read(member.size)
+                if len(data) != member.size:
+                    raise tarfile.ReadError("unexpected end of data")
+
+                return data
+
+            member_file = self.archive_object.extractfile(member)
+            if not member_file:
+                return b""
+
+            with member_file:
+                return member_file.read()
+        finally:
+            super()._release_lock()
+
+    def extract_many(self, roots, extraction_path):
+        # One linear pass over the stream for the whole batch rather than
+        # one (potentially backwards) seek per member
+        pending_members = []
+        for root in roots:
+            assert root in self.members, "Unknown member path specified: %s" % root
+
+            self._expand_item(root, extraction_path, pending_members)
+
+        self._extract_in_order(pending_members, extraction_path)
+
+    def _expand_item(self, root, extraction_path, pending_members):
         file_obj = self.members[root]
 
         if not root:
-            self._expand_children(None, extraction_path)
+            self._expand_children(None, extraction_path, pending_members)
             return
 
         member = None
@@ -634,7 +1090,7 @@ class XDelta3TarImpl(XDelta3AbstractArchiveImpl):
 
             self._safe_makedirs(folder_path)
 
-            self._expand_children(root, extraction_path)
+            self._expand_children(root, extraction_path, pending_members)
 
             # TODO: Move this to end of extraction
             # XXX: Does not do anything right now
@@ -651,8 +1107,7 @@ class XDelta3TarImpl(XDelta3AbstractArchiveImpl):
 
             return
 
-        if not path.lexists(extraction_path):
-            makedirs(extraction_path, exist_ok=True)
+        self._safe_makedirs(extraction_path)
 
         # Manually handle symlinks
         if file_obj.is_link:
@@ -665,12 +1120,7 @@ class XDelta3TarImpl(XDelta3AbstractArchiveImpl):
             target_dir = path.join(extraction_path, root)
             self._safe_makedirs(target_dir)
         else:
-            # XXX: Not thread safe http://bugs.python.org/issue23649
-            super()._acquire_lock()
-            try:
-                self.archive_object.extract(member, extraction_path)
-            finally:
-                super()._release_lock()
+            pending_members.append(member)
 
     # TODO: Copy uid/gid/permissions from source folder into records
     def create(self, base_dir):
@@ -680,6 +1130,8 @@ class XDelta3TarImpl(XDelta3AbstractArchiveImpl):
 
 
 class XDelta3ZipImpl(XDelta3AbstractArchiveImpl):
+    COPY_BUFFER_SIZE = 1024 * 1024
+
     def __init__(self, archive_path, for_writing=False):
         super().__init__()
 
@@ -696,12 +1148,20 @@ class XDelta3ZipImpl(XDelta3AbstractArchiveImpl):
         self.archive_object = zipfile.ZipFile(archive_path, flags)
         self.archive_path = archive_path
 
+        # Read-only handles for the member extraction, one per thread
+        self._thread_local = threading.local()
+        self._reader_archives = []
+
         # Pre-fetch member data to ensure only one thread tries to create
         # the initial list and to allow further listings to not need locks
         if not for_writing:
             self.list_items()
 
     def _close_archive(self):
+        for reader_archive in self._reader_archives:
+            reader_archive.close()
+        self._reader_archives = []
+
         self.archive_object.close()
 
     def __enter__(self):
@@ -717,8 +1177,7 @@ class XDelta3ZipImpl(XDelta3AbstractArchiveImpl):
     def can_open(archive):
         return path.isfile(archive) and zipfile.is_zipfile(archive)
 
-    def _add_listing_object(self, dir_listing, method, name):
-        zip_obj = self.archive_object.getinfo(name)
+    def _add_listing_object(self, dir_listing, method, zip_obj):
         setter_func = getattr(dir_listing, method)
 
         basename = ""
@@ -733,26 +1192,33 @@ class XDelta3ZipImpl(XDelta3AbstractArchiveImpl):
     # XXX: Not thread safe when uninitialized
     @property
     def members(self):
-        if self._members:
+        if self._members is not None:
             return self._members
 
         items = {}
 
         print("Zip: Gathering filelist (%s)" % path.basename(self.archive_path))
 
-        # Sorted to ensure that we do top-down traversal
-        sorted_names = sorted(self.archive_object.namelist(), key=len)
+        # Binned by depth to ensure that we do top-down traversal without
+        # having to sort the whole (possibly huge) list of names
+        depth_bins = {}
+        for zip_obj in self.archive_object.infolist():
+            depth = zip_obj.filename.rstrip(path.sep).count(path.sep)
+            depth_bins.setdefault(depth, []).append(zip_obj)
 
         items[None] = DirListing(path.basename(self.archive_path))
 
-        for name in sorted_names:
+        for zip_obj in (
+            zip_obj for depth in sorted(depth_bins) for zip_obj in depth_bins[depth]
+        ):
+            name = zip_obj.filename
             if name.endswith(path.sep):
                 fixed_name = name.rstrip(path.sep)
                 dir_listing = DirListing()
 
                 items[fixed_name] = dir_listing
 
-                self._add_listing_object(dir_listing, "set_metadata", name)
+                self._add_listing_object(dir_listing, "set_metadata", zip_obj)
 
                 parent_dir = path.dirname(fixed_name)
                 if not parent_dir:
@@ -766,7 +1232,7 @@ class XDelta3ZipImpl(XDelta3AbstractArchiveImpl):
 
                 dir_listing = items[dir_name]
 
-                file_obj = self._add_listing_object(dir_listing, "add_file", name)
+                file_obj = self._add_listing_object(dir_listing, "add_file", zip_obj)
                 items[name] = file_obj
 
         print("Zip: Gathering completed (%s)" % path.basename(self.archive_path))
@@ -778,13 +1244,51 @@ class XDelta3ZipImpl(XDelta3AbstractArchiveImpl):
 
         return self._members
 
+    def _get_reader_archive(self):
+        # Extractions from a shared ZipFile all serialize on its internal
+        # lock so each thread reads through its own handle and seek pointer
+        # instead. The central directory is cheap to re-parse.
+        reader_archive = getattr(self._thread_local, "archive_object", None)
+        if not reader_archive:
+            reader_archive = zipfile.ZipFile(self.archive_path, "r")
+            self._thread_local.archive_object = reader_archive
+
+            super()._acquire_lock()
+            try:
+                self._reader_archives.append(reader_archive)
+            finally:
+                super()._release_lock()
+
+        return reader_archive
+
     def expand(self, root, extraction_path):
         assert root in self.members, "Unknown member path specified: %s" % root
 
-        if not path.isdir(extraction_path):
-            makedirs(extraction_path, exist_ok=True)
+        zip_obj = self.members[root].data
 
-        self.archive_object.extract(self.members[root].data, extraction_path)
+        # Same member name sanitization that ZipFile.extract() does
+        segments = [
+            segment
+            for segment in zip_obj.filename.split("/")
+            if segment not in ("", path.curdir, path.pardir)
+        ]
+        target_path = path.join(extraction_path, *segments)
+
+        if zip_obj.is_dir():
+            self._safe_makedirs(target_path)
+            return
+
+        self._safe_makedirs(path.dirname(target_path))
+
+        # Streamed with a fixed-size buffer rather than going through
+        # ZipFile.extract() which re-resolves the member on every call
+        with self._get_reader_archive().open(zip_obj) as source_file, open(
+            target_path, "wb"
+        ) as target_file:
+            copyfileobj(source_file, target_file, self.COPY_BUFFER_SIZE)
+
+    def read_member(self, root):
+        return self._get_reader_archive().read(self.members[root].data)
 
     def create(self, base_dir):
         for root, dirnames, filenames in walk(base_dir):
@@ -821,9 +1325,46 @@ class XDelta3Impl(object):
         print(command_line)
         stdout.flush()
 
+    # Files up to this size get diffed in-process if possible
+    IN_PROCESS_MAX_SIZE = 4 * 1024 * 1024
+
+    @staticmethod
+    def _diff_in_process(old_file, new_file, target_file, debug=False):
+        if not xdelta3 or not old_file:
+            return False
+
+        max_size = XDelta3Impl.IN_PROCESS_MAX_SIZE
+        if stat(old_file).st_size > max_size or stat(new_file).st_size > max_size:
+            return False
+
+        with open(old_file, "rb") as source_file:
+            source = source_file.read()
+
+        with open(new_file, "rb") as input_file:
+            data = input_file.read()
+
+        try:
+            delta = xdelta3.encode(source, data)
+        except xdelta3.NoDeltaFound:
+            # The bindings refuse deltas that are bigger than the input
+            # so let the command line tool handle those
+            return False
+
+        if debug:
+            print("XD Diff (in-process):", old_file, new_file, target_file)
+            stdout.flush()
+
+        with open(target_file, "wb") as delta_file:
+            delta_file.write(delta)
+
+        return True
+
     # TODO: Test me
     @staticmethod
     def diff(old_file, new_file, target_file, debug=False):
+        if XDelta3Impl._diff_in_process(old_file, new_file, target_file, debug):
+            return
+
         command = ["lib/xdelta3", "-f", "-e"]
         if old_file:
             command.append("-s")
@@ -837,21 +1378,194 @@ class XDelta3Impl(object):
 
         XDelta3Impl.run_command(command)
 
+    @staticmethod
+    def _apply_in_process(old_file, patch_data, target_file, debug=False):
+        if not xdelta3 or not old_file:
+            return False
+
+        # XXX: This only bounds how much of the source we read into memory.
+        #      The decoded output can be far bigger than either input but the
+        #      bindings cap their output buffer and raise XDeltaError when it
+        #      runs out, which gets us the command line tool below.
+        max_size = XDelta3Impl.IN_PROCESS_MAX_SIZE
+        if stat(old_file).st_size > max_size or len(patch_data) > max_size:
+            return False
+
+        with open(old_file, "rb") as source_file:
+            source = source_file.read()
+
+        try:
+            data = xdelta3.decode(source, patch_data)
+        except xdelta3.XDeltaError:
+            # Let the command line tool deal with (and report) anything that
+            # the bindings can't handle
+            return False
+
+        if debug:
+            print("XD Apply (in-process):", old_file, target_file)
+            stdout.flush()
+
+        with open(target_file, "wb") as new_file:
+            new_file.write(data)
+
+        return True
+
     # TODO: Test me
     @staticmethod
-    def apply(old_file, patch_file, target_file, debug=False):
-        command = ["lib/xdelta3", "-f", "-d"]
+    def apply_stream(old_file, patch_data, target_file, debug=False):
+        if XDelta3Impl._apply_in_process(old_file, patch_data, target_file, debug):
+            return
+
+        # Feeds the patch on stdin so that it never has to hit the disk
+        command = ["lib/xdelta3", "-f", "-d", "-c"]
         if old_file:
             command.append("-s")
             command.append(old_file)
 
-        command.append(patch_file)
-        command.append(target_file)
-
         if debug:
-            XDelta3Impl._print_command("XD Apply:", command)
+            XDelta3Impl._print_command("XD Apply (stdin):", command)
+
+        # XXX: The output goes to a temporary file next to the target that
+        #      replaces it at the end since for in-place updates the target
+        #      is the source that xdelta3 is still reading from
+        output_fd, output_file = mkstemp(dir=path.dirname(target_file) or None)
+        try:
+            with open(output_fd, "wb") as output:
+                process = Popen(command, stdin=PIPE, stdout=output, stderr=PIPE)
+                _, error_output = process.communicate(patch_data)
+
+            if not process.returncode:
+                replace(output_file, target_file)
+        finally:
+            if path.lexists(output_file):
+                remove(output_file)
+
+        if process.returncode:
+            print()
+            print(
+                "XDELTA FAIL:",
+                process.returncode,
+                error_output.decode(errors="replace"),
+            )
+            print()
+
+            raise CalledProcessError(process.returncode, command, stderr=error_output)
+
+
+# ---------------------------- PATCH APPLICATION ----------------------------
+# XXX: These live outside of the patcher so that the apply tasks only need
+#      picklable arguments and can run on the process runner backend
+
+# Directories (and their ancestors) that the apply tasks of this process
+# know exist already
+_created_dirs = set()
+_created_dirs_lock = threading.Lock()
+
+
+def ensure_dir(target_dir):
+    cached_makedirs(target_dir, _created_dirs, _created_dirs_lock)
+
+
+def copy_attributes_from_info(options, patch_info, target):
+    if patch_info.permissions:
+        chmod(target, patch_info.permissions)
+
+    if patch_info.uid and patch_info.gid:
+        try:
+            lchown(target, patch_info.uid, patch_info.gid)
+        except PermissionError as pe:
+            # We only ignore problems here if ignore_euid flag is set
+            if not options.ignore_euid:
+                raise pe
+        except NameError as ne:
+            pass
 
-        XDelta3Impl.run_command(command)
+
+def apply_file_delta(
+    options,
+    delta_impl,
+    rel_path,
+    patch_info,
+    patch_data,
+    old_prefix,
+    target_prefix,
+):
+    # The prefixes come with a trailing separator so plain concatenation
+    # gives us the paths without going through path.join() for every file
+    old_path = old_prefix + rel_path
+    target_path = target_prefix + rel_path
+
+    # Member names always use "/" while the prefixes use the native separator
+    target_dir = target_prefix + rel_path.rpartition("/")[0]
+    if options.debug:
+        print("Apply:", old_path, rel_path, target_path)
+        stdout.flush()
+
+    if patch_info.is_link:
+        ensure_dir(target_dir)
+
+        patch_dst = patch_info.link_target
+        symlink(patch_dst, target_path)
+        if options.debug:
+            print("symlink: ", [target_path, patch_dst])
+
+    elif patch_info.is_dir:
+        ensure_dir(target_path)
+        copy_attributes_from_info(options, patch_info, target_path)
+    else:
+        ensure_dir(target_dir)
+
+        # Regular file. Directory listings of the old version already know
+        # whether the source is there so we only stat if they couldn't tell.
+        old_is_file = patch_info.old_is_file
+        if old_is_file is None:
+            old_is_file = path.isfile(old_path)
+
+        if not old_is_file:
+            if options.debug:
+                print("File missing: '%s'." "Ignoring source in XDelta" % old_path)
+            old_path = None
+
+        if old_path and not patch_data:
+            # Empty patches are files that didn't change
+            if options.debug:
+                print("Unchanged file. Copying:", old_path, target_path)
+
+            if old_path != target_path:
+                copyfile(old_path, target_path)
+            elif path.islink(old_path):
+                # In-place updates of a symlink that became a regular file
+                # with the same contents (older bundles could have these)
+                # need the link replaced with a copy of what it points to
+                copy_fd, copy_path = mkstemp(dir=target_dir)
+                try:
+                    close(copy_fd)
+                    copyfile(old_path, copy_path)
+                    replace(copy_path, target_path)
+                finally:
+                    if path.lexists(copy_path):
+                        remove(copy_path)
+        else:
+            delta_impl.apply_stream(old_path, patch_data, target_path, options.debug)
+
+        if options.verbose:
+            print("Copying file metadata (archive):", rel_path)
+        copy_attributes_from_info(options, patch_info, target_path)
+
+
+def apply_file_deltas(options, delta_impl, old_prefix, target_prefix, patch_batch):
+    # Each task handles a whole batch of patches to cut down on the
+    # scheduling and pickling overhead that we'd have per patch
+    for rel_path, patch_info, patch_data in patch_batch:
+        apply_file_delta(
+            options,
+            delta_impl,
+            rel_path,
+            patch_info,
+            patch_data,
+            old_prefix,
+            target_prefix,
+        )
 
 
 # ---------------------------- MAIN CLASS ----------------------------
@@ -859,10 +1573,31 @@ class XDelta3DirPatcher(object):
     PATCH_FOLDER = "xdelta"
     METADATA_FILE = ".info"
 
+    # Formats that the patch bundle can be compressed with
+    COMPRESSIONS = ("gz", "zstd", "none")
+
+    # Most patches are tiny so the apply tasks get them in batches of (at most)
+    # this many
+    APPLY_BATCH_SIZE = 64
+
+    # tarfile only copies the member data in 16 KiB chunks by default
+    BUNDLE_COPY_BUFFER_SIZE = 2 * 1024 * 1024
+
     def __init__(self, args, delta_impl=XDelta3Impl):
         self.args = args
         self.delta_impl = delta_impl
 
+        # Progress printer for the per-file tasks of the current run
+        self._progress = None
+
+    def _progress_printer(self, runner, symbol):
+        # Debug output is per file anyways and quiet runs (e.g. from scripts)
+        # have nobody watching the progress
+        if self.args.debug or self.args.quiet:
+            return None
+
+        return runner.progress(symbol)
+
     # TODO: Unit test me
     def copy_attributes(self, src_file, dest_file):
         if self.args.verbose:
@@ -878,24 +1613,21 @@ class XDelta3DirPatcher(object):
         except NameError as ne:
             pass
 
-    # TODO: Unit test me
-    def copy_attributes_from_archive(self, archive_object, filename, target):
-        if self.args.verbose:
-            print("Copying file metadata (archive):", filename)
-        file_obj = archive_object.list_items()[filename]
+    @staticmethod
+    def _files_identical(old_file, new_file, chunk_size=1024 * 1024):
+        if stat(old_file).st_size != stat(new_file).st_size:
+            return False
 
-        if file_obj.permissions:
-            chmod(target, file_obj.permissions)
+        # Plain chunked comparison bails out on the first difference and,
+        # unlike hashing both files, never needs to read past it
+        with open(old_file, "rb") as old_fd, open(new_file, "rb") as new_fd:
+            while True:
+                old_chunk = old_fd.read(chunk_size)
+                if old_chunk != new_fd.read(chunk_size):
+                    return False
 
-        if file_obj.uid and file_obj.gid:
-            try:
-                lchown(target, file_obj.uid, file_obj.gid)
-            except PermissionError as pe:
-                # We only ignore problems here if ignore_euid flag is set
-                if not self.args.ignore_euid:
-                    raise pe
-            except NameError as ne:
-                pass
+                if not old_chunk:
+                    return True
 
     def _find_file_delta(
         self,
@@ -905,16 +1637,19 @@ class XDelta3DirPatcher(object):
         old_root,
         new_root,
         target_root,
+        expand_new=True,
+        expand_old=True,
     ):
         if self.args.debug:
             print("Processing '%s'" % filename)
-        else:
-            print("#", end="")
-        stdout.flush()
+            stdout.flush()
+        elif self._progress:
+            self._progress.tick()
 
-        new_archive_obj.expand(filename, new_root)
+        if expand_new:
+            new_archive_obj.expand(filename, new_root)
 
-        if filename in old_archive_obj.list_items().keys():
+        if expand_old and filename in old_archive_obj.list_items():
             old_archive_obj.expand(filename, old_root)
 
         old_path = path.join(old_root, filename)
@@ -925,20 +1660,30 @@ class XDelta3DirPatcher(object):
         if self.args.debug:
             print("Diff:", old_path, new_path, target_path)
 
-        if path.islink(path.abspath(new_path)):
-            source_path = path.abspath(new_path)
-            dest_path = path.abspath(target_path)
+        # One lstat of the new file tells us everything that we need to know
+        # about it for the rest of the processing
+        new_mode = lstat(new_path).st_mode
 
-            target_dir = path.dirname(dest_path)
+        if S_ISLNK(new_mode):
             if not path.lexists(target_dir):
                 makedirs(target_dir, exist_ok=True)
 
-            new_dst = readlink(source_path)
-            symlink(new_dst, dest_path)
+            # The staged symlink is what we want in the patch folder so if
+            # it's on the same filesystem we just move it over
+            try:
+                rename(new_path, target_path)
+            except OSError as oe:
+                if oe.errno != errno.EXDEV:
+                    raise oe
+
+                new_dst = readlink(new_path)
+                symlink(new_dst, target_path)
+                remove(new_path)
+
             if self.args.debug:
-                print("symlink: ", [source_path, dest_path])
+                print("symlink: ", [new_path, target_path])
 
-        elif path.isdir(new_path):
+        elif S_ISDIR(new_mode):
             if not path.lexists(target_dir):
                 makedirs(target_dir, exist_ok=True)
 
@@ -953,70 +1698,103 @@ class XDelta3DirPatcher(object):
                 if self.args.debug:
                     print("Old file not present. Ignoring source in XDelta")
 
-            self.delta_impl.diff(old_path, new_path, target_path, self.args.debug)
+            # XXX: Symlinks that turned into regular files compare as
+            #      identical since the comparison follows them but they still
+            #      need to get replaced so they don't get an empty patch
+            if (
+                old_path
+                and not path.islink(old_path)
+                and self._files_identical(old_path, new_path)
+            ):
+                # Unchanged files are stored as empty patches (xdelta3
+                # output never is) so that we can skip xdelta3 entirely
+                if self.args.debug:
+                    print("Unchanged file. Writing empty patch:", target_path)
+
+                open(target_path, "wb").close()
+            else:
+                self.delta_impl.diff(old_path, new_path, target_path, self.args.debug)
 
             self.copy_attributes(new_path, target_path)
 
         # Remove each individual file as they're processed
         # to reduce needed size on-disk
-        for item in [old_path, new_path]:
-            if item and (path.isfile(item) or path.islink(item)):
-                remove(item)
+        if old_path and (path.isfile(old_path) or path.islink(old_path)):
+            remove(old_path)
 
-    def _apply_file_delta(
-        self,
-        archive_object,
-        patch_file,
-        old_root,
-        target_root,
-        delta_patch_root,
-        staging_dir,
-    ):
-        if self.args.debug:
-            print("Processing '%s'" % patch_file)
-        else:
-            print("#", end="")
-        stdout.flush()
-
-        archive_object.expand(patch_file, staging_dir)
+        if S_ISREG(new_mode):
+            remove(new_path)
 
-        rel_path = path.relpath(patch_file, delta_patch_root)
-        old_path = path.join(old_root, rel_path)
-        patch_path = path.join(staging_dir, patch_file)
-        target_path = path.join(target_root, rel_path)
+    def _add_bundle_contents(self, patch_archive, delta_target_dir, metadata):
+        patch_archive.add(delta_target_dir, arcname=self.PATCH_FOLDER)
 
-        target_dir = path.dirname(target_path)
-        if args.debug:
-            print("Apply:", old_path, patch_path, target_path)
-
-        if path.islink(patch_path):
-            if path.normpath(target_path) != target_dir and not path.isdir(target_dir):
-                if args.debug:
-                    print("Creating parent of a symlink:", target_dir)
-                makedirs(target_dir, exist_ok=True)
+        if metadata:
+            print("Adding metadata (.info)")
+            patch_archive.add(metadata, arcname=self.METADATA_FILE)
 
-            patch_dst = readlink(patch_path)
-            symlink(patch_dst, target_path)
-            if args.debug:
-                print("symlink: ", [target_path, patch_dst])
+    def _write_patch_bundle(
+        self, patch_bundle, delta_target_dir, metadata, compression="gz"
+    ):
+        assert compression in self.COMPRESSIONS, (
+            "Unknown bundle compression: %s" % compression
+        )
 
-        elif path.isdir(patch_path):
-            makedirs(target_path, exist_ok=True)
-            self.copy_attributes_from_archive(archive_object, patch_file, target_path)
-        else:
-            makedirs(target_dir, exist_ok=True)
+        if compression == "zstd":
+            self._write_zstd_patch_bundle(patch_bundle, delta_target_dir, metadata)
+            return
 
-            # Regular file
-            if not path.isfile(old_path):
-                if args.debug:
-                    print("File missing: '%s'." "Ignoring source in XDelta" % old_path)
-                old_path = None
+        pigz = which("pigz")
+        if compression == "none" or not pigz:
+            with tarfile.open(
+                patch_bundle,
+                "w" if compression == "none" else "w:gz",
+                format=tarfile.GNU_FORMAT,
+                copybufsize=self.BUNDLE_COPY_BUFFER_SIZE,
+            ) as patch_archive:
+                self._add_bundle_contents(patch_archive, delta_target_dir, metadata)
 
-            self.delta_impl.apply(old_path, patch_path, target_path, self.args.debug)
+            return
 
-            self.copy_attributes_from_archive(archive_object, patch_file, target_path)
+        # Compression is what the bundle writing spends its time on so if we
+        # can, we have pigz do it on all of the cores
+        command = [pigz, "-c", "-p", str(cpu_count())]
+        if self.args.debug:
+            print("Compressing with:", " ".join(command))
 
-            remove(patch_path)
+        with open(patch_bundle, "wb") as bundle_file:
+            compressor = Popen(command, stdin=PIPE, stdout=bundle_file)
+            try:
+                with tarfile.open(
+                    fileobj=compressor.stdin,
+                    mode="w|",
+                    format=tarfile.GNU_FORMAT,
+                    copybufsize=self.BUNDLE_COPY_BUFFER_SIZE,
+                ) as patch_archive:
+                    self._add_bundle_contents(
+                        patch_archive, delta_target_dir, metadata
+                    )
+            finally:
+                compressor.stdin.close()
+                returncode = compressor.wait()
+
+        if returncode:
+            raise CalledProcessError(returncode, command)
+
+    def _write_zstd_patch_bundle(self, patch_bundle, delta_target_dir, metadata):
+        # Multi-threaded and much cheaper per byte than gzip for the already
+        # compact xdelta3 payloads
+        compressor = zstandard.ZstdCompressor(level=3, threads=-1)
+        with open(patch_bundle, "wb") as bundle_file:
+            with compressor.stream_writer(bundle_file, closefd=False) as zstd_file:
+                with tarfile.open(
+                    fileobj=zstd_file,
+                    mode="w|",
+                    format=tarfile.GNU_FORMAT,
+                    copybufsize=self.BUNDLE_COPY_BUFFER_SIZE,
+                ) as patch_archive:
+                    self._add_bundle_contents(
+                        patch_archive, delta_target_dir, metadata
+                    )
 
     # TODO: Unit test me
     def diff(
@@ -1027,7 +1805,14 @@ class XDelta3DirPatcher(object):
         metadata=None,
         staging_dir=None,
         runner=ExecutorRunner(),
+        compression="gz",
     ):
+        # Fail before doing any of the work if we can't write the bundle
+        if compression == "zstd" and not zstandard:
+            raise RuntimeError(
+                "Error! zstd compression needs the zstandard module installed!"
+            )
+
         target_dir = mkdtemp(
             prefix="%s_target" % XDelta3DirPatcher.__name__, dir=staging_dir
         )
@@ -1042,25 +1827,45 @@ class XDelta3DirPatcher(object):
         with XDeltaArchive(old_dir) as old_archive_obj, XDeltaArchive(
             new_dir
         ) as new_archive_obj:
+            # The sources get staged next to the patches so that a single
+            # rmtree() at the end cleans up everything
             old_staging_dir = mkdtemp(
-                prefix="%s_old_src" % XDelta3DirPatcher.__name__, dir=staging_dir
+                prefix="%s_old_src" % XDelta3DirPatcher.__name__, dir=target_dir
             )
             new_staging_dir = mkdtemp(
-                prefix="%s_new_src" % XDelta3DirPatcher.__name__, dir=staging_dir
+                prefix="%s_new_src" % XDelta3DirPatcher.__name__, dir=target_dir
             )
 
-            for filename in new_archive_obj.list_items().keys():
-                if not filename:
-                    continue
+            filenames = [f for f in new_archive_obj.list_items().keys() if f]
+
+            # Sequential archives are expanded in one pass here so that the
+            # tasks only need to do the per-file diffing
+            expand_new = not new_archive_obj.SEQUENTIAL_ACCESS
+            if not expand_new:
+                print("Expanding new files (%s)" % path.basename(new_dir))
+                new_archive_obj.extract_many(filenames, new_staging_dir)
+
+            expand_old = not old_archive_obj.SEQUENTIAL_ACCESS
+            if not expand_old:
+                print("Expanding old files (%s)" % path.basename(old_dir))
+                old_items = old_archive_obj.list_items()
+                old_archive_obj.extract_many(
+                    [f for f in filenames if f in old_items], old_staging_dir
+                )
 
+            # Queueing is reported through a progress printer too so that we
+            # don't do a write and a flush for every single file
+            queue_progress = self._progress_printer(runner, ".")
+
+            delta_tasks = []
+            for filename in filenames:
                 if self.args.debug:
                     print("Queueing '%s'" % filename)
-                else:
-                    print(".", end="")
-                stdout.flush()
+                    stdout.flush()
+                elif queue_progress:
+                    queue_progress.tick()
 
-                runner.add_task(
-                    self._find_file_delta,
+                delta_tasks.append(
                     (
                         filename,
                         old_archive_obj,
@@ -1068,58 +1873,54 @@ class XDelta3DirPatcher(object):
                         old_staging_dir,
                         new_staging_dir,
                         delta_target_dir,
-                    ),
+                        expand_new,
+                        expand_old,
+                    )
                 )
 
+            self._progress = self._progress_printer(runner, "#")
+            runner.map(self._find_file_delta, delta_tasks)
+
             # Wait until we diffed everything
             runner.join_all()
 
         # FIXME: Figure out how to handle dirs (premissions/uids/etc)
 
-        rmtree(old_staging_dir)
-        rmtree(new_staging_dir)
-
         # TODO: Delegate this to archive impl
         print("\nWriting archive...")
-        with tarfile.open(
-            patch_bundle, "w:gz", format=tarfile.GNU_FORMAT
-        ) as patch_archive:
-            patch_archive.add(delta_target_dir, arcname=self.PATCH_FOLDER)
-
-            if metadata:
-                print("Adding metadata (.info)")
-                patch_archive.add(metadata, arcname=self.METADATA_FILE)
+        self._write_patch_bundle(patch_bundle, delta_target_dir, metadata, compression)
 
         print("Cleaning up...")
         rmtree(target_dir)
 
         print("Done")
 
-    # XXX This implementation needs directories passed in to be
-    #     empty for proper cleanup. Callers are required to send
-    #     in files first if they expect a mixture of dirs/files
-    #     on the same paths.
+    # XXX This implementation only removes the non-directory entries and
+    #     returns the directories to the caller. These can only be removed
+    #     once all of the tasks removing their children are done.
     @staticmethod
-    def remove_item(target_dir, deleted_item, debug=False, attempt=0):
-        deleted_item_path = path.join(target_dir, deleted_item)
-        if debug:
-            print("Deleting '%s'" % deleted_item_path)
-        else:
-            print("X", end="")
+    def remove_dir_items(target_dir, dir_name, deleted_names, debug=False):
+        # One scandir per directory gives us the entry types for free rather
+        # than needing a couple of stats for every deleted item
+        removed_dirs = []
+        try:
+            with scandir(path.join(target_dir, dir_name)) as entries:
+                for entry in entries:
+                    if entry.name not in deleted_names:
+                        continue
+
+                    if entry.is_dir(follow_symlinks=False):
+                        removed_dirs.append(entry.path)
+                        continue
+
+                    if debug:
+                        print("Deleting '%s'" % entry.path)
+                    remove(entry.path)
+        except (FileNotFoundError, NotADirectoryError) as e:
+            # Nothing to remove here
+            pass
 
-        if not path.lexists(deleted_item_path):
-            return
-
-        if path.isdir(deleted_item_path):
-            try:
-                rmdir(deleted_item_path)
-            except OSError as e:
-                # We don't care about directories that might get leftover
-                # since they will be empty anyways but we do our best to
-                # clean up
-                pass
-        else:
-            remove(deleted_item_path)
+        return removed_dirs
 
     # TODO: Unit test me
     def apply(
@@ -1129,16 +1930,21 @@ class XDelta3DirPatcher(object):
         target_dir,
         root_patch_dir=None,
         staging_dir=None,
-        runner=ExecutorRunner(),
+        runner=None,
     ):
+        # xdelta3 application is CPU-bound so the patches get applied in
+        # separate processes. The pool is only created here so that importing
+        # this module for the worker processes doesn't start another one.
+        if not runner:
+            runner = ExecutorRunner(backend="process")
+
         in_place_apply = old_dir == target_dir
 
-        # TODO: Test me
-        # Create a temp dir
-        patch_staging_dir = mkdtemp(
-            prefix="%s_delta_expanded" % XDelta3DirPatcher.__name__, dir=staging_dir
-        )
-        print("Using '%s' as staging area" % patch_staging_dir)
+        # Anything that we knew about may have been removed since the last run
+        _created_dirs.clear()
+
+        # XXX: Patches get piped straight into xdelta3 so apply doesn't need
+        #      a staging area anymore. The argument is kept for the callers.
 
         # If we want to apply only a part of the xdelta files
         # from withing the delta bundle xdelta/ folder
@@ -1174,24 +1980,21 @@ class XDelta3DirPatcher(object):
             #      to be able to compare the file lists and build a "to_remove"
             #      array. The reason why we use len() vs path.relpath() is so that
             #      we don't strip out the trailing path.sep() on directories that
-            #      relpath does automatically
-            files_in_patch = []
-            for filename in patches:
-                relative_filename = filename[len(delta_patch_root) + len(path.sep) :]
-                files_in_patch.append(relative_filename)
+            #      relpath does automatically. This is a set so that the
+            #      removal check below isn't quadratic.
+            prefix_length = len(delta_patch_root) + len(path.sep)
+            files_in_patch = {filename[prefix_length:] for filename in patches}
 
             if self.args.verbose:
                 print("In patch: %s" % files_in_patch)
 
-            removed_items = []
+            # Removals are grouped by their parent directory so that each
+            # directory only needs to be looked at by a single task
+            removed_items = {}
             for old_file in old_archive.list_items().keys():
                 if old_file and old_file not in files_in_patch:
-                    removed_items.append(old_file)
-
-            # XXX: This is to ensure that we never try to remove a directory while
-            #      all of its children are in queue waiting for a thread (causing
-            #      a deadlock)
-            removed_items.sort(key=len, reverse=True)
+                    dir_name, _, name = old_file.rpartition(path.sep)
+                    removed_items.setdefault(dir_name, set()).add(name)
 
             if self.args.verbose:
                 print("Removed: %s" % removed_items)
@@ -1199,38 +2002,131 @@ class XDelta3DirPatcher(object):
             # TODO: Verify that old archive has the expected files before we start
 
             print("Removing deleted files")
-            for removed_item in removed_items:
-                if self.args.debug:
-                    print("Queueing(rm) '%s'" % removed_item)
-                else:
-                    print("x", end="")
+            # Queueing is reported through progress printers too so that we
+            # don't do a write and a flush for every single item
+            removal_queue_progress = self._progress_printer(runner, "x")
+            removal_progress = self._progress_printer(runner, "X")
 
-                runner.add_task(
-                    self.remove_item, (target_dir, removed_item, self.args.debug)
+            removal_futures = []
+            for dir_name, deleted_names in removed_items.items():
+                if self.args.debug:
+                    print("Queueing(rm) '%s': %s" % (dir_name, deleted_names))
+                elif removal_queue_progress:
+                    removal_queue_progress.tick()
+
+                removal_futures.append(
+                    runner.add_task(
+                        self.remove_dir_items,
+                        (target_dir, dir_name, deleted_names, self.args.debug),
+                        removal_progress,
+                    )
                 )
 
-            for patch in patches:
+            removed_dirs = []
+            for removal_result in runner.results_of(removal_futures):
+                removed_dirs.extend(removal_result)
+
+            # XXX: Children have to go before their parents and since the dir
+            #      removal is just an rmdir, doing it here is simpler than
+            #      ordering it across tasks
+            removed_dirs.sort(key=len, reverse=True)
+            for removed_dir in removed_dirs:
                 if self.args.debug:
-                    print("Queueing '%s'" % patch)
-                else:
-                    print(".", end="")
-                stdout.flush()
+                    print("Deleting '%s'" % removed_dir)
+
+                try:
+                    rmdir(removed_dir)
+                except OSError as e:
+                    # We don't care about directories that might get leftover
+                    # since they will be empty anyways but we do our best to
+                    # clean up
+                    pass
 
-                runner.add_task(
-                    self._apply_file_delta,
+            # The patches are read out of the bundle in a single pass and
+            # handed over to the tasks in batches along with their contents.
+            # We bound the number of queued batches so that the bundle isn't
+            # read into memory faster than the patches can be applied.
+            queued_batches = threading.BoundedSemaphore(runner.worker_count * 2)
+
+            # Smaller bundles still need enough batches to keep every worker
+            # busy
+            batch_size = min(
+                self.APPLY_BATCH_SIZE,
+                max(1, len(patches) // (runner.worker_count * 4)),
+            )
+
+            apply_progress = self._progress_printer(runner, "#")
+
+            old_prefix = path.join(old_dir, "")
+            target_prefix = path.join(target_dir, "")
+
+            # Directory listings are keyed by the same relative paths as the
+            # patches and come with the scandir() types that we need
+            old_listing = None
+            if isinstance(old_archive, XDelta3FsImpl):
+                old_listing = old_archive.list_items()
+
+            def queue_batch(patch_batch):
+                queued_batches.acquire()
+                future = runner.add_task(
+                    apply_file_deltas,
                     (
-                        patch_archive,
-                        patch,
-                        old_dir,
-                        target_dir,
-                        delta_patch_root,
-                        patch_staging_dir,
+                        self.args,
+                        self.delta_impl,
+                        old_prefix,
+                        target_prefix,
+                        patch_batch,
                     ),
+                    apply_progress,
+                    len(patch_batch),
+                )
+                future.add_done_callback(lambda _: queued_batches.release())
+
+            patch_batch = []
+            queue_progress = self._progress_printer(runner, ".")
+            for patch, file_obj, patch_data in patch_archive.stream_members(patches):
+                if self.args.debug:
+                    print("Queueing '%s'" % patch)
+                    stdout.flush()
+                elif queue_progress:
+                    queue_progress.tick()
+
+                rel_path = patch[prefix_length:]
+
+                # Symlinks need to be followed to know if there's a source
+                old_is_file = None
+                if old_listing is not None:
+                    # Listings of directories are keyed by native paths
+                    old_file_obj = old_listing.get(rel_path.replace("/", sep))
+                    if not old_file_obj:
+                        old_is_file = False
+                    elif not old_file_obj.is_link:
+                        old_is_file = old_file_obj.is_file
+
+                # Archive listing objects hold on to the archive handles so
+                # only the metadata that we need gets sent to the workers.
+                # Folders that were only implied by their children have none.
+                patch_info = AttributeDict(
+                    {
+                        "is_link": file_obj.is_link,
+                        "link_target": getattr(file_obj, "link_target", None),
+                        "is_dir": file_obj.is_dir,
+                        "permissions": getattr(file_obj, "permissions", None),
+                        "uid": getattr(file_obj, "uid", None),
+                        "gid": getattr(file_obj, "gid", None),
+                        "old_is_file": old_is_file,
+                    }
                 )
-            runner.join_all()
 
-        print("Cleaning up")
-        rmtree(patch_staging_dir)
+                patch_batch.append((rel_path, patch_info, patch_data))
+                if len(patch_batch) >= batch_size:
+                    queue_batch(patch_batch)
+                    patch_batch = []
+
+            if patch_batch:
+                queue_batch(patch_batch)
+
+            runner.join_all()
 
         print("Done")
 
@@ -1260,6 +2156,7 @@ class XDelta3DirPatcher(object):
                 self.args.patch_bundle,
                 self.args.metadata,
                 self.args.staging_dir,
+                compression=self.args.compression,
             )
         else:
             # If we're not the root user, bail since we can't ensure that the
@@ -1335,6 +2232,14 @@ if __name__ == "__main__":
         help="Add this file (renamed to .info) as metadata to the diff",
     )
 
+    parser_diff.add_argument(
+        "-c",
+        "--compression",
+        choices=XDelta3DirPatcher.COMPRESSIONS,
+        default="gz",
+        help="Compression to use for the patch bundle (default: gz)",
+    )
+
     parser_diff.add_argument(
         "old_version", help="Folder or archive containing the old version of the files"
     )
@@ -1364,6 +2269,12 @@ if __name__ == "__main__":
         action="store_true",
     )
 
+    parser.add_argument(
+        "--quiet",
+        help="Disable the per-file progress output",
+        action="store_true",
+    )
+
     parser.add_argument("--version", action="version", version="%(prog)s v" + VERSION)
 
     args = AttributeDict(vars(parser.parse_args()))
@@ -1,25 +1,40 @@
-import os
+import io
+import shutil
+import struct
 import subprocess
 import zipfile
 import urllib.request
-import shutil
+
+
+def crx_zip_offset(crx_data):
+    # CRX files are a zip archive with a header in front of it
+    magic, version, size = struct.unpack_from("<4sII", crx_data)
+    if magic != b"Cr24":
+        return 0
+
+    if version == 2:
+        (signature_size,) = struct.unpack_from("<I", crx_data, 12)
+        return 16 + size + signature_size
+
+    return 12 + size
 
 
 ext_id = input("Enter a Chrome extension id: ")
 
 crx_url = f"https://clients2.google.com/service/update2/crx?response=redirect&prodversion=31.0.1609.0&acceptformat=crx2,crx3&x=id%3D{ext_id}%26uc"
 
-urllib.request.urlretrieve(crx_url, "original.crx")
+with urllib.request.urlopen(crx_url) as response:
+    crx_data = response.read()
 
-with zipfile.ZipFile("original.crx", "r") as zip_ref:
+zip_data = io.BytesIO(crx_data[crx_zip_offset(crx_data) :])
+with zipfile.ZipFile(zip_data, "r") as zip_ref:
     zip_ref.extractall("original")
 
 subprocess.run(
-    "python3 lib/xdelta3-dir-patcher.py apply --ignore-euid original patch patched",
+    "python3 lib/xdelta3-dir-patcher.py --quiet apply --ignore-euid original patch patched",
     shell=True,
 )
 
-os.remove("original.crx")
 shutil.rmtree("original")
 
 print("------------------")